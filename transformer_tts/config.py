@@ -4,6 +4,8 @@ _C = CN()
 _C.data = CN(
     dict(
         batch_size=16, # batch size
+        num_workers=4, # number of subprocesses for data loading
+        num_buckets=20, # examples are grouped into buckets by text length
         valid_size=64, # the first N examples are reserved for validation
         sample_rate=22050, # Hz, sample rate
         n_fft=1024, # fft frame size
@@ -12,6 +14,7 @@ _C.data = CN(
         f_max=8000, # Hz, max frequency when converting to mel
         d_mel=80,  # mel bands
         padding_idx=0, # text embedding's padding index
+        pad_to_multiple=16, # pad text & frames of a batch to a multiple of it
         mel_start_value=0.5, # value for starting frame
         mel_end_value=-0.5, # # value for ending frame
     )
@@ -32,6 +35,8 @@ _C.model = CN(
         max_reduction_factor=10,  # max_reduction factor
         dropout=0.1,  # global droput probability
         stop_loss_scale=8.0, # scaler for stop _loss
+        guided_attention_scale=1.0, # scaler for guided attention loss, 0 to disable
+        guided_attention_sigma=0.2, # width of the diagonal band of guided attention
         decoder_prenet_dropout=0.5, # decoder prenet dropout probability
     )
 )
@@ -39,9 +44,16 @@ _C.model = CN(
 _C.training = CN(
     dict(
         lr=1e-4, # learning rate
+        weight_decay=0.0, # decoupled weight decay, not applied to biases & norms
+        amp=True, # use automatic mixed precision
+        accum_steps=1, # number of batches to accumulate gradients over per update
+        comm_buffer_size=50, # MB, gradient bucket size for all-reduce
+        last_comm_buffer_size=1, # MB, size of the last gradient bucket
         drop_n_heads=[[0, 0], [15000, 1]],
         reduction_factor=[[0, 10], [80000, 4], [200000, 2]],
-        plot_interval=1000, # plot attention and spectrogram
+        log_interval=10, # fetch losses from device & log
+        plot_interval=5, # plot attention every N validations
+        num_attention_plots=2, # number of validation sentences to plot
         valid_interval=1000, # validation
         save_interval=10000, # checkpoint
         max_iteration=900000, # max iteration to train
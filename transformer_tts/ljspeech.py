@@ -2,9 +2,8 @@ import os
 from pathlib import Path
 import pickle
 import numpy as np
-from paddle.io import Dataset, DataLoader
+from paddle.io import Dataset, DataLoader, BatchSampler
 
-from parakeet.data.batch import batch_spec, batch_text_id
 from parakeet.data import dataset
 
 class LJSpeech(Dataset):
@@ -16,12 +15,25 @@ class LJSpeech(Dataset):
             metadata = pickle.load(f)
         for mel_name, text, phonemes, ids in metadata:
             mel_name = self.root / "mel" / (mel_name + ".npy")
+            # convert ids once here instead of every time the example is loaded
+            ids = np.array(ids, dtype=np.int64)
             records.append((mel_name, text, phonemes, ids))
         self.records = records
 
+        # use packed mel spectrograms if preprocess.py has created them
+        if (self.root / "mels.npy").exists():
+            self.mels = np.load(self.root / "mels.npy", mmap_mode='r')
+            self.mel_index = np.load(self.root / "mel_index.npy")
+        else:
+            self.mels = None
+
     def __getitem__(self, i):
         mel_name, _, _, ids = self.records[i]
-        mel = np.load(mel_name)
+        if self.mels is None:
+            mel = np.load(mel_name)
+        else:
+            offset, n_frames = self.mel_index[i]
+            mel = self.mels[offset: offset + n_frames].T
         return ids, mel
 
     def __len__(self):
@@ -36,7 +48,7 @@ class Transform(object):
 
     def __call__(self, example):
         ids, mel = example # ids already have <s> and </s>
-        ids = np.array(ids, dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
         # add start and end frame
         mel = np.pad(mel, 
                      [(0, 0), (1, 1)], 
@@ -48,21 +60,126 @@ class Transform(object):
         return ids, mel, stop_labels
 
 
+def round_up(length, multiple):
+    return (length + multiple - 1) // multiple * multiple
+
+
 class LJSpeechCollector(object):
-    """A simple callable to batch LJSpeech examples."""
-    def __init__(self, padding_idx=0, padding_value=0.):
+    """A simple callable to batch LJSpeech examples.
+    
+    Text and frames are padded to a multiple of ``pad_to_multiple`` so that 
+    batches come in a small set of shapes, which lets the shape-keyed caches 
+    of the framework (cuDNN algorithms, allocator blocks) be reused.
+
+    Batches are written into buffers that are kept across calls instead of 
+    newly allocated arrays. The returned arrays are views of these buffers 
+    and are overwritten by the next call, so they must be consumed before 
+    then, as the DataLoader does when converting them to tensors. Each 
+    DataLoader needs its own collector, since loaders may collate batches 
+    concurrently in their own threads.
+    """
+    def __init__(self, padding_idx=0, padding_value=0., pad_to_multiple=1):
         self.padding_idx = padding_idx
         self.padding_value = padding_value
+        self.pad_to_multiple = pad_to_multiple
+        self.buffers = {}
+
+    def get_buffer(self, name, shape, dtype, fill_value):
+        # a flat buffer reshaped on demand, so the returned view is contiguous
+        size = int(np.prod(shape))
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.size < size:
+            buffer = np.empty([size], dtype=dtype)
+            self.buffers[name] = buffer
+        array = buffer[:size].reshape(shape)
+        array.fill(fill_value)
+        return array
 
     def __call__(self, examples):
-        ids = [example[0] for example in examples]
-        mels = [example[1] for example in examples]
-        stop_probs = [example[2] for example in examples]
+        batch_size = len(examples)
+        text_length = round_up(
+            max(len(example[0]) for example in examples), self.pad_to_multiple)
+        frames = round_up(
+            max(example[1].shape[-1] for example in examples), self.pad_to_multiple)
+        d_mel = examples[0][1].shape[0]
+
+        ids = self.get_buffer(
+            "ids", (batch_size, text_length), np.int64, self.padding_idx)
+        mels = self.get_buffer(
+            "mels", (batch_size, frames, d_mel), np.float32, self.padding_value)
+        stop_probs = self.get_buffer(
+            "stop_probs", (batch_size, frames), np.int64, self.padding_idx)
+        for i, (example_ids, mel, stop_prob) in enumerate(examples):
+            ids[i, :len(example_ids)] = example_ids
+            mels[i, :mel.shape[-1]] = mel.T
+            stop_probs[i, :len(stop_prob)] = stop_prob
+        return ids, mels, stop_probs
+
+
+class BucketBatchSampler(BatchSampler):
+    """A batch sampler that puts examples of similar lengths into the same 
+    batch to reduce padding. 
+    
+    Examples are sorted by length and split into ``num_buckets`` buckets. 
+    Each bucket is shuffled and cut into batches, then the batches from all 
+    buckets are shuffled.
+    """
+    def __init__(self, lengths, batch_size, num_buckets=20, shuffle=True, drop_last=True):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_buckets = num_buckets
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def make_batches(self, rng):
+        indices = np.argsort(self.lengths, kind="stable")
+        batches = []
+        for bucket in np.array_split(indices, self.num_buckets):
+            if self.shuffle:
+                rng.shuffle(bucket)
+            for start in range(0, len(bucket), self.batch_size):
+                batch = bucket[start: start + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch.tolist())
+        if self.shuffle:
+            rng.shuffle(batches)
+        return batches
 
-        ids = batch_text_id(ids, pad_id=self.padding_idx)
-        mels = batch_spec(mels, pad_value=self.padding_value)
-        stop_probs = batch_text_id(stop_probs, pad_id=self.padding_idx)
-        return ids, np.transpose(mels, [0, 2, 1]), stop_probs
+    def __iter__(self):
+        return iter(self.make_batches(np.random))
+
+    def __len__(self):
+        num_batches = 0
+        for bucket_size in map(len, np.array_split(self.lengths, self.num_buckets)):
+            if self.drop_last:
+                num_batches += bucket_size // self.batch_size
+            else:
+                num_batches += (bucket_size + self.batch_size - 1) // self.batch_size
+        return num_batches
+
+
+class DistributedBucketBatchSampler(BucketBatchSampler):
+    """Distributed version of ``BucketBatchSampler``. Every rank builds the 
+    same batches with the epoch as random seed and takes every 
+    ``num_replicas``-th of them, so each rank gets the same number of batches.
+    """
+    def __init__(self, lengths, batch_size, num_replicas, rank, num_buckets=20, shuffle=True, drop_last=True):
+        super().__init__(lengths, batch_size, num_buckets, shuffle, drop_last)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        batches = self.make_batches(np.random.RandomState(self.epoch))
+        num_batches = len(batches) // self.num_replicas
+        return iter(batches[self.rank::self.num_replicas][:num_batches])
+
+    def __len__(self):
+        return super().__len__() // self.num_replicas
 
 
 def create_dataloader(config, source_path):
@@ -71,18 +188,17 @@ def create_dataloader(config, source_path):
     lj = dataset.TransformDataset(lj, transform)
 
     valid_set, train_set = dataset.split(lj, config.data.valid_size)
-    data_collator = LJSpeechCollector(padding_idx=config.data.padding_idx)
     train_loader = DataLoader(
         train_set, 
         batch_size=config.data.batch_size, 
         shuffle=True, 
         drop_last=True,
-        collate_fn=data_collator)
+        collate_fn=LJSpeechCollector(padding_idx=config.data.padding_idx))
     valid_loader = DataLoader(
         valid_set,
         batch_size=config.data.batch_size,
         shuffle=False,
         drop_last=False,
-        collate_fn=data_collator)
+        collate_fn=LJSpeechCollector(padding_idx=config.data.padding_idx))
     return train_loader, valid_loader
 
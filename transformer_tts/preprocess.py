@@ -29,6 +29,7 @@ def create_dataset(config, source_path, target_path, verbose=False):
     normalizer = LogMagnitude()
     
     records = []
+    frames = []
     for (fname, text, _) in tqdm.tqdm(meta_data):
         wav = processor.read_wav(fname)
         mel = processor.mel_spectrogram(wav)
@@ -39,9 +40,14 @@ def create_dataset(config, source_path, target_path, verbose=False):
 
         # save mel spectrogram
         records.append((mel_name, text, phonemes, ids))
+        frames.append(mel.shape[-1])
         np.save(mel_path / mel_name, mel)
     if verbose:
         print("save mel spectrograms into {}".format(mel_path))
+
+    pack_mels(target_path, records, frames, config.data.d_mel)
+    if verbose:
+        print("packed mel spectrograms into {}".format(target_path / "mels.npy"))
     
     # save meta data as pickle archive
     with open(target_path / "metadata.pkl", 'wb') as f:
@@ -60,6 +66,24 @@ def create_dataset(config, source_path, target_path, verbose=False):
     print("Done.")
 
 
+def pack_mels(target_path, records, frames, d_mel):
+    """Pack all mel spectrograms into a single (total_frames, d_mel) array 
+    with an index of (offset, frames) for each example, so that the dataset 
+    can memory map it instead of opening a file per example."""
+    offsets = np.cumsum([0] + frames[:-1])
+    mel_index = np.stack([offsets, frames], axis=-1).astype(np.int64)
+    packed = np.lib.format.open_memmap(
+        str(target_path / "mels.npy"), 
+        mode="w+", 
+        dtype=np.float32, 
+        shape=(sum(frames), d_mel))
+    for (mel_name, _, _, _), (offset, n_frames) in zip(records, mel_index):
+        mel = np.load(target_path / "mel" / (mel_name + ".npy"))
+        packed[offset: offset + n_frames] = mel.T
+    packed.flush()
+    np.save(target_path / "mel_index.npy", mel_index)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="create dataset")
     parser.add_argument("--config", type=str, metavar="FILE", help="extra config to overwrite the default config")
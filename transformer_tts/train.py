@@ -46,8 +46,10 @@ def main_sp(config, args):
         train_loader = DataLoader(
             train_set, batch_sampler=sampler, collate_fn=batch_fn)
 
+    # the collector reuses its buffers, so each loader gets its own
+    valid_batch_fn = LJSpeechCollector(padding_idx=config.data.padding_idx)
     valid_loader = DataLoader(
-        valid_set, batch_size=config.data.batch_size, collate_fn=batch_fn)
+        valid_set, batch_size=config.data.batch_size, collate_fn=valid_batch_fn)
 
     frontend = English()
     model = TransformerTTS(
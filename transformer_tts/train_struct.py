@@ -1,10 +1,12 @@
 import time
 import logging
+import contextlib
+from dataclasses import dataclass
 from pathlib import Path
 import numpy as np
 import paddle
 from paddle import distributed as dist
-from paddle.io import DataLoader, DistributedBatchSampler
+from paddle.io import DataLoader
 from tensorboardX import SummaryWriter
 from collections import defaultdict
 
@@ -17,7 +19,57 @@ from parakeet.training.cli import default_argument_parser
 from parakeet.training.experiment import ExperimentBase
 
 from config import get_cfg_defaults
-from ljspeech import LJSpeech, LJSpeechCollector, Transform
+from ljspeech import LJSpeech, LJSpeechCollector, Transform, BucketBatchSampler, DistributedBucketBatchSampler
+
+@dataclass(frozen=True)
+class _TrainConfig:
+    """Snapshot of the config entries read at every step, so that the hot 
+    path does not go through CfgNode lookups."""
+    amp: bool
+    accum_steps: int
+    log_interval: int
+    plot_interval: int
+    num_attention_plots: int
+    padding_idx: int
+    guided_attention_scale: float
+    guided_attention_sigma: float
+
+
+def stack_losses(losses):
+    """Stack a dict of scalar losses into one tensor of shape(K,) so that it 
+    can be fetched to host with a single copy."""
+    # reshape since scalar losses may be 0-D or shape(1,) tensors
+    return paddle.concat(
+        [v.astype("float32").reshape([1]) for v in losses.values()])
+
+
+def guided_attention_loss(attention_weights, text_lengths, decoder_lengths, sigma):
+    """Guided attention loss, which penalizes attention weights far from the 
+    diagonal (https://arxiv.org/abs/1710.08969).
+
+    Args:
+        attention_weights (List[Tensor]): attention weights of each layer, 
+            shape(B, H, T_dec, T_enc).
+        text_lengths (Tensor): valid text lengths, shape(B,).
+        decoder_lengths (Tensor): valid decoder steps, shape(B,).
+        sigma (float): width of the diagonal band.
+
+    Returns:
+        Tensor: the loss, averaged over layers, heads and valid positions.
+    """
+    decoder_steps, text_steps = attention_weights[0].shape[-2:]
+    n = paddle.arange(text_steps, dtype="float32").unsqueeze(0) / text_lengths.unsqueeze(-1)
+    t = paddle.arange(decoder_steps, dtype="float32").unsqueeze(0) / decoder_lengths.unsqueeze(-1)
+    penalty = 1. - paddle.exp(-(n.unsqueeze(1) - t.unsqueeze(2)) ** 2 / (2 * sigma ** 2))
+    mask = (n < 1.).astype("float32").unsqueeze(1) * (t < 1.).astype("float32").unsqueeze(2)
+    penalty = (penalty * mask).unsqueeze(1) # (B, 1, T_dec, T_enc)
+
+    loss = 0.
+    for weights in attention_weights:
+        n_heads = weights.shape[1]
+        loss += paddle.sum(weights.astype("float32") * penalty) / (paddle.sum(mask) * n_heads)
+    return loss / len(attention_weights)
+
 
 class Experiment(ExperimentBase):
     def compute_outputs(self, text, mel, stop_label):
@@ -33,7 +85,7 @@ class Experiment(ExperimentBase):
         return outputs
 
     def compute_losses(self, inputs, outputs):
-        _, mel, stop_label = inputs
+        text, mel, stop_label = inputs
         mel_target = mel[:, 1:, :]
         stop_label_target = stop_label[:, 1:]
 
@@ -41,6 +93,9 @@ class Experiment(ExperimentBase):
         mel_intermediate = outputs["mel_intermediate"]
         stop_logits = outputs["stop_logits"]
 
+        # padded mel frames are all zeros, and the criterion masks out target 
+        # frames that are all zeros, so padding adds no loss. This requires 
+        # the collector's padding_value to stay 0.
         time_steps = mel_target.shape[1]
         losses = self.criterion(
             mel_output[:,:time_steps, :], 
@@ -48,47 +103,112 @@ class Experiment(ExperimentBase):
             mel_target, 
             stop_logits[:,:time_steps, :], 
             stop_label_target)
+
+        train_config = self.train_config
+        if train_config.guided_attention_scale > 0:
+            model_core = self.model._layers if self.parallel else self.model
+            text_lengths = paddle.sum(
+                (text != train_config.padding_idx).astype("float32"), axis=-1)
+            frame_lengths = paddle.sum(
+                (stop_label_target != 0).astype("float32"), axis=-1)
+            decoder_lengths = paddle.ceil(frame_lengths / model_core.r)
+            attention_loss = guided_attention_loss(
+                outputs["cross_attention_weights"], 
+                text_lengths, 
+                decoder_lengths, 
+                train_config.guided_attention_sigma)
+            losses["guided_attention_loss"] = attention_loss
+            losses["loss"] = losses["loss"] + train_config.guided_attention_scale * attention_loss
         return losses
 
+    def auto_cast(self):
+        # keep softmax and layer_norm in float32 for numerical stability
+        return paddle.amp.auto_cast(
+            enable=self.train_config.amp,
+            custom_black_list={'softmax', 'layer_norm'})
+
     def train_batch(self):
-        start = time.time()
-        batch = self.read_batch()
-        data_loader_time = time.time() - start
+        accum_steps = self.train_config.accum_steps
+        log_interval = self.train_config.log_interval
+        if self.log_start is None:
+            # start a timing window; the device is idle here since the last 
+            # log, validation or checkpoint has waited for it
+            self.log_start = time.time()
+            self.window_steps = 0
+            self.data_loader_time = 0.
+        self.window_steps += 1
 
-        self.optimizer.clear_grad()
+        # release gradients instead of filling them with zeros
+        self.optimizer.clear_grad(set_to_zero=False)
         self.model.train()
-        text, mel, stop_label = batch
-        outputs = self.compute_outputs(text, mel, stop_label)
-        losses = self.compute_losses(batch, outputs)
-        loss = losses["loss"]
-        loss.backward() 
-        self.optimizer.step()
-        iteration_time = time.time() - start
-
-        losses_np = {k: float(v) for k, v in losses.items()}
+        for micro_step in range(accum_steps):
+            read_start = time.time()
+            batch = self.read_batch()
+            self.data_loader_time += time.time() - read_start
+
+            # gradients are only all-reduced for the last batch
+            if self.parallel and micro_step < accum_steps - 1:
+                sync_context = self.model.no_sync()
+            else:
+                sync_context = contextlib.nullcontext()
+            with sync_context:
+                text, mel, stop_label = batch
+                with self.auto_cast():
+                    outputs = self.compute_outputs(text, mel, stop_label)
+                    losses = self.compute_losses(batch, outputs)
+                loss = losses["loss"] / accum_steps
+                scaled_loss = self.scaler.scale(loss)
+                scaled_loss.backward() 
+        self.scaler.minimize(self.optimizer, scaled_loss)
+
+        # fetching losses blocks until the device finishes the step, so only 
+        # do it when logging, and only rank 0 logs
+        if self.iteration % log_interval != 0:
+            return
+        if self.rank != 0:
+            self.log_start = None
+            return
+        losses_np = dict(zip(losses.keys(), stack_losses(losses).numpy().tolist()))
+        # the device has caught up after fetching the losses, so the time 
+        # since the window started is accurate without extra synchronization
+        now = time.time()
+        data_loader_time = self.data_loader_time / self.window_steps
+        iteration_time = (now - self.log_start) / self.window_steps
+        self.log_start = now
+        self.window_steps = 0
+        self.data_loader_time = 0.
         # logging
-        msg = "Rank: {}, ".format(dist.get_rank())
+        msg = "Rank: {}, ".format(self.rank)
         msg += "step: {}, ".format(self.iteration)
         msg += "time: {:>.3f}s/{:>.3f}s, ".format(data_loader_time, iteration_time)
         msg += ', '.join('{}: {:>.6f}'.format(k, v) for k, v in losses_np.items())
         self.logger.info(msg)
         
-        if dist.get_rank() == 0:
-            for k, v in losses_np.items():
-                self.visualizer.add_scalar(f"train_loss/{k}", v, self.iteration)
+        for k, v in losses_np.items():
+            self.visualizer.add_scalar(f"train_loss/{k}", v, self.iteration)
     
     @mp_tools.rank_zero_only
     @paddle.no_grad()
     def valid(self):
-        valid_losses = defaultdict(list)
+        train_config = self.train_config
+        plot = self.valid_calls % train_config.plot_interval == 0
+        self.valid_calls += 1
+        # running sum of the stacked losses, kept on device
+        valid_loss_sum = None
+        num_batches = 0
         for i, batch in enumerate(self.valid_loader):
             text, mel, stop_label = batch
-            outputs = self.compute_outputs(text, mel, stop_label)
-            losses = self.compute_losses(batch, outputs)
-            for k, v in losses.items():
-                valid_losses[k].append(float(v))
+            with self.auto_cast():
+                outputs = self.compute_outputs(text, mel, stop_label)
+                losses = self.compute_losses(batch, outputs)
+            batch_losses = stack_losses(losses)
+            if valid_loss_sum is None:
+                valid_loss_sum = batch_losses
+            else:
+                valid_loss_sum = valid_loss_sum + batch_losses
+            num_batches += 1
 
-            if i < 2:
+            if plot and i < train_config.num_attention_plots:
                 attention_weights = outputs["cross_attention_weights"]
                 display.add_attention_plots(
                     self.visualizer, 
@@ -96,13 +216,50 @@ class Experiment(ExperimentBase):
                     attention_weights, 
                     self.iteration)
 
+        # validation is not counted in the step time
+        self.log_start = None
+        if num_batches == 0:
+            return
+
         # write visual log
-        valid_losses = {k: np.mean(v) for k, v in valid_losses.items()}
+        valid_losses = (valid_loss_sum / num_batches).numpy()
+        valid_losses = dict(zip(losses.keys(), valid_losses.tolist()))
         for k, v in valid_losses.items():
             self.visualizer.add_scalar(f"valid/{k}", v, self.iteration)
 
+    @mp_tools.rank_zero_only
+    def save(self):
+        super().save()
+        # the loss scale is saved alongside the checkpoint so that resuming 
+        # does not have to find it again
+        if self.train_config.amp:
+            scaler_path = Path(self.checkpoint_dir) / "step-{}.pdscaler".format(self.iteration)
+            paddle.save(self.scaler.state_dict(), str(scaler_path))
+        # checkpointing is not counted in the step time
+        self.log_start = None
+
+    def resume_or_load(self):
+        super().resume_or_load()
+        if not self.train_config.amp:
+            return
+        if self.args.checkpoint_path:
+            scaler_path = Path(self.args.checkpoint_path + ".pdscaler")
+        else:
+            scaler_path = Path(self.checkpoint_dir) / "step-{}.pdscaler".format(self.iteration)
+        if scaler_path.exists():
+            self.scaler.load_state_dict(paddle.load(str(scaler_path)))
+
     def setup_model(self):
         config = self.config
+        self.train_config = _TrainConfig(
+            amp=config.training.amp,
+            accum_steps=config.training.accum_steps,
+            log_interval=config.training.log_interval,
+            plot_interval=config.training.plot_interval,
+            num_attention_plots=config.training.num_attention_plots,
+            padding_idx=config.data.padding_idx,
+            guided_attention_scale=config.model.guided_attention_scale,
+            guided_attention_sigma=config.model.guided_attention_sigma)
         frontend = English()
         model = TransformerTTS(
             frontend, 
@@ -121,20 +278,36 @@ class Experiment(ExperimentBase):
             decoder_prenet_dropout=config.model.decoder_prenet_dropout,
             dropout=config.model.dropout)
         if self.parallel:
-            model = paddle.DataParallel(model)
-        optimizer = paddle.optimizer.Adam(
-            learning_rate=1e-4,
+            # gradients are all-reduced in buckets, overlapping with backward
+            model = paddle.DataParallel(
+                model, 
+                comm_buffer_size=config.training.comm_buffer_size,
+                last_comm_buffer_size=config.training.last_comm_buffer_size)
+        optimizer = paddle.optimizer.AdamW(
+            learning_rate=config.training.lr,
             beta1=0.9,
             beta2=0.98,
             epsilon=1e-9,
-            parameters=model.parameters()
+            parameters=model.parameters(),
+            weight_decay=config.training.weight_decay,
+            apply_decay_param_fun=lambda name: not (name.endswith(".b_0") or "norm" in name)
         )
+        scaler = paddle.amp.GradScaler(
+            enable=config.training.amp, init_loss_scaling=2**15)
         criterion = TransformerTTSLoss(config.model.stop_loss_scale)
         drop_n_heads = scheduler.StepWise(config.training.drop_n_heads)
         reduction_factor = scheduler.StepWise(config.training.reduction_factor)
 
+        self.rank = dist.get_rank()
+        self.valid_calls = 0
+        # timings are averaged over a window of steps, which starts at the 
+        # first step and restarts after each log, validation and checkpoint
+        self.log_start = None
+        self.window_steps = 0
+        self.data_loader_time = 0.
         self.model = model
         self.optimizer = optimizer
+        self.scaler = scaler
         self.criterion = criterion
         self.drop_n_heads = drop_n_heads
         self.reduction_factor = reduction_factor
@@ -144,36 +317,61 @@ class Experiment(ExperimentBase):
         config = self.config
 
         ljspeech_dataset = LJSpeech(args.data)
+        # text lengths of the training examples, used to bucket batches
+        train_lengths = [
+            len(ids) for _, _, _, ids in ljspeech_dataset.records[config.data.valid_size:]]
         transform = Transform(config.data.mel_start_value, config.data.mel_end_value)
         ljspeech_dataset = dataset.TransformDataset(ljspeech_dataset, transform)
         valid_set, train_set = dataset.split(ljspeech_dataset, config.data.valid_size)
-        batch_fn = LJSpeechCollector(padding_idx=config.data.padding_idx)
+        # the collector reuses its buffers, so each loader gets its own
+        batch_fn = LJSpeechCollector(
+            padding_idx=config.data.padding_idx,
+            pad_to_multiple=config.data.pad_to_multiple)
+        valid_batch_fn = LJSpeechCollector(
+            padding_idx=config.data.padding_idx,
+            pad_to_multiple=config.data.pad_to_multiple)
         
         if not self.parallel:
-            train_loader = DataLoader(
-                train_set, 
-                batch_size=config.data.batch_size, 
-                shuffle=True, 
-                drop_last=True,
-                collate_fn=batch_fn)
+            sampler = BucketBatchSampler(
+                train_lengths,
+                batch_size=config.data.batch_size,
+                num_buckets=config.data.num_buckets,
+                shuffle=True,
+                drop_last=True)
         else:
-            sampler = DistributedBatchSampler(
-                train_set, 
+            sampler = DistributedBucketBatchSampler(
+                train_lengths, 
                 batch_size=config.data.batch_size,
                 num_replicas=dist.get_world_size(),
                 rank=dist.get_rank(),
+                num_buckets=config.data.num_buckets,
                 shuffle=True,
                 drop_last=True)
-            train_loader = DataLoader(
-                train_set, batch_sampler=sampler, collate_fn=batch_fn)
+        train_loader = DataLoader(
+            train_set, 
+            batch_sampler=sampler, 
+            collate_fn=batch_fn,
+            num_workers=config.data.num_workers,
+            use_buffer_reader=True,
+            use_shared_memory=True,
+            return_list=True)
 
+        # the validation set is small, starting worker processes for it on 
+        # every validation costs more than it saves
         valid_loader = DataLoader(
-            valid_set, batch_size=config.data.batch_size, collate_fn=batch_fn)
+            valid_set, 
+            batch_size=config.data.batch_size, 
+            collate_fn=valid_batch_fn,
+            use_buffer_reader=True,
+            return_list=True)
 
         self.train_loader = train_loader
         self.valid_loader = valid_loader
 
 def main_sp(config, args):
+    if args.device == "gpu":
+        # benchmark cuDNN conv algorithms instead of picking them by heuristic
+        paddle.set_flags({"FLAGS_cudnn_exhaustive_search": True})
     exp = Experiment(config, args)
     exp.setup()
     exp.run()